@@ -5,113 +5,414 @@ import sys
 # Add libs folder to sys.path
 sys.path.append(os.path.join(os.path.dirname(__file__), 'libs'))
 
+import heapq
 import json
 import logging
-import subprocess
+import threading
+from collections import OrderedDict
 from ulauncher.api.client.Extension import Extension
 from ulauncher.api.client.EventListener import EventListener
-from ulauncher.api.shared.event import KeywordQueryEvent, ItemEnterEvent
+from ulauncher.api.shared.event import KeywordQueryEvent, ItemEnterEvent, SystemExitEvent
 from ulauncher.api.shared.item.ExtensionResultItem import ExtensionResultItem
 from ulauncher.api.shared.action.RenderResultListAction import RenderResultListAction
 from ulauncher.api.shared.action.CopyToClipboardAction import CopyToClipboardAction
-from ulauncher.api.shared.action.BaseAction import BaseAction
-from fuzzywuzzy import fuzz
+from ulauncher.api.shared.action.ExtensionCustomAction import ExtensionCustomAction
+try:
+    import orjson
+except ImportError:  # Fall back to the standard library json module
+    orjson = None
 
 # Path to history file
 HISTORY_FILE = os.path.join(os.path.dirname(__file__), 'history.json')
 
+# Fuzzy matching: weights of the title/content scores and minimum combined score
+TITLE_WEIGHT = 0.8
+CONTENT_WEIGHT = 0.2
+FUZZY_SCORE_THRESHOLD = 50
+
+# Number of results shown in Ulauncher
+MAX_RESULTS = 5
+
+# Number of distinct queries kept in the selection history (least recently used are dropped)
+MAX_HISTORY_QUERIES = 100
+
+# Seconds to wait after a selection before writing the history, so quick selections share one write
+HISTORY_FLUSH_DELAY = 2.0
+
+# Number of recent queries whose ranked results are kept in memory
+RESULT_CACHE_SIZE = 64
+
+# Only the beginning of long snippets is used for scoring, bounding the cost per snippet
+MAX_SCORED_CONTENT_LENGTH = 2048
+
+# Shorter queries are only matched against snippet names: their partial_ratio against content is noise
+MIN_CONTENT_QUERY_LENGTH = 3
+
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# Fuzzy matching library, imported on the first query that needs scoring to keep startup cheap
+fuzz = None
+process = None
+
+def load_fuzzy_matcher():
+    """Import the fuzzy matching library if it isn't loaded yet"""
+    global fuzz, process
+    if fuzz is not None:
+        return
+    try:
+        from rapidfuzz import fuzz, process
+    except ImportError:  # Fall back to the slower pure-Python implementation
+        from fuzzywuzzy import fuzz
+        process = None
+
+def read_json(path):
+    """Parse a JSON file, with orjson when available"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    return orjson.loads(data) if orjson else json.loads(data)
+
+def write_json(path, obj):
+    """Write obj to a JSON file, with orjson when available"""
+    data = orjson.dumps(obj) if orjson else json.dumps(obj, separators=(',', ':')).encode()
+    # Write to a temporary file and swap it in, so an interrupted write can't leave a truncated file behind
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def get_content_text(snippet):
+    """Return the content of a snippet as a single string"""
+    content = snippet.get('content', '')
+    if isinstance(content, list):
+        return "\n".join(fragment.get('value', '') for fragment in content)
+    return content
+
+def score_choices(query, choices, score_cutoff=0, substring_first=False):
+    """Return {key: score} for every choice scoring at least score_cutoff against query.
+
+    choices is either a list (keys are indexes) or a dict of key -> string.
+    With substring_first, choices containing query get 100 without running the scorer:
+    worth it for long texts, while short names are cheaper to score in a single batch.
+    """
+    scores = {}
+    if substring_first:
+        # A substring always gets a perfect partial_ratio, so only the rest need the fuzzy scorer
+        remaining = {}
+        for key, choice in (choices.items() if isinstance(choices, dict) else enumerate(choices)):
+            if query and query in choice:
+                scores[key] = 100
+            else:
+                remaining[key] = choice
+    else:
+        remaining = choices
+
+    if process is not None:
+        # Score the whole batch in a single C++ loop
+        scores.update((key, score) for _, score, key in process.extract(
+            query, remaining, scorer=fuzz.partial_ratio, processor=None,
+            limit=None, score_cutoff=score_cutoff))
+        return scores
+
+    for key, choice in (remaining.items() if isinstance(remaining, dict) else enumerate(remaining)):
+        score = fuzz.partial_ratio(query, choice)
+        if score >= score_cutoff:
+            scores[key] = score
+    return scores
+
 class MassCodeExtension(Extension):
     def __init__(self):
         super(MassCodeExtension, self).__init__()
         self.subscribe(KeywordQueryEvent, KeywordQueryEventListener())
         self.subscribe(ItemEnterEvent, ItemEnterEventListener())
+        self.subscribe(SystemExitEvent, SystemExitEventListener())
+
+        # Parsed db.json, keyed by file version so it is only re-read when it changes.
+        # snippet_cache_key also tells listeners when their derived caches went stale.
+        self._snippet_cache = None
+        self.snippet_cache_key = None
+        self._name_index = {}
+
+        # Lowercased search fields of the cached snippets, as lists parallel to the snippet list
+        self.snippet_names_lower = []
+        self.snippet_contents_lower = []
+
+        # In-memory selection history. history_version changes on every update; changes
+        # are written to history.json by a timer so bursts of selections share one write,
+        # and whatever is still pending when Ulauncher shuts the extension down.
+        self._history_cache = None
+        self.history_version = 0
+        self._history_dirty = False
+        self._history_flush_timer = None
+        self._history_lock = threading.Lock()
+
+        # Expanded database path, recomputed only when the preference changes
+        self._db_path = None
+        self._db_path_preference = None
+
+    def get_db_path(self):
+        """Return the expanded path to the MassCode database"""
+        db_path_preference = self.preferences['mc_db_path']
+        if db_path_preference != self._db_path_preference:
+            self._db_path = os.path.expanduser(db_path_preference)
+            self._db_path_preference = db_path_preference
+        return self._db_path
 
     def load_snippets(self, db_path):
         """Load snippets from db.json file"""
         try:
-            with open(db_path, 'r') as f:
-                data = json.load(f)
-            return [snippet for snippet in data.get("snippets", []) if not snippet.get("isDeleted", False)]
+            stat = os.stat(db_path)
+            cache_key = (db_path, stat.st_mtime_ns, stat.st_size)
+            if cache_key == self.snippet_cache_key:
+                return self._snippet_cache
+
+            data = read_json(db_path)
+            snippets = [snippet for snippet in data.get("snippets", []) if not snippet.get("isDeleted", False)]
+            for snippet in snippets:
+                # Join the fragments and build the preview once per load instead of on every keystroke.
+                # The raw fragments are not needed afterwards.
+                content_text = get_content_text(snippet)
+                snippet['content_text'] = content_text
+                snippet['preview'] = content_text[:100] + '...' if len(content_text) > 100 else content_text
+                snippet.pop('content', None)
+                # History is keyed by name, so interned names make those lookups cheaper
+                snippet['name'] = sys.intern(snippet.get('name', ''))
+
+            # Lowercase once per load, into plain lists that can be handed to the scorer as is
+            self.snippet_names_lower = [snippet.get('name', '').lower() for snippet in snippets]
+            self.snippet_contents_lower = [snippet['content_text'][:MAX_SCORED_CONTENT_LENGTH].lower() for snippet in snippets]
+            self._name_index = {}
+            for index, snippet in enumerate(snippets):
+                self._name_index.setdefault(snippet['name'], []).append(index)
+            self._snippet_cache = snippets
+            self.snippet_cache_key = cache_key
+            return self._snippet_cache
         except Exception as e:
             logger.error("Error loading snippets from db.json: %s", e)
+            self.snippet_cache_key = None
+            self._name_index = {}
+            self.snippet_names_lower = []
+            self.snippet_contents_lower = []
             return []
 
+    def find_snippets_by_name(self, name):
+        """Return the indexes of the cached snippets named name"""
+        return self._name_index.get(name, [])
+
     def load_history(self):
         """Load selection history from history.json file"""
+        # Only this extension writes the file and save_history keeps the cache
+        # up to date, so once loaded there is no need to stat it again
+        if self._history_cache is not None:
+            return self._history_cache
+
         try:
-            with open(HISTORY_FILE, 'r') as f:
-                return json.load(f)
+            history = OrderedDict(
+                (query, {sys.intern(snippet_name): count for snippet_name, count in query_history.items()})
+                for query, query_history in read_json(HISTORY_FILE).items()
+            )
         except (FileNotFoundError, json.JSONDecodeError):
-            return {}
+            history = OrderedDict()
+        self._history_cache = history
+        return history
 
     def save_history(self, history):
         """Save selection history to history.json file"""
         try:
-            with open(HISTORY_FILE, 'w') as f:
-                json.dump(history, f, indent=4)
+            write_json(HISTORY_FILE, history)
+            # Keep the in-memory copy so the next query doesn't parse what was just written
+            self._history_cache = history
         except Exception as e:
             logger.error("Error saving selection history: %s", e)
 
+    def update_history(self, query, snippet_name):
+        """Count one more selection of snippet_name for query"""
+        with self._history_lock:
+            history = self.load_history()
+            query_history = history.setdefault(query, {})
+            snippet_name = sys.intern(snippet_name)
+            query_history[snippet_name] = query_history.get(snippet_name, 0) + 1
+
+            # Most recently used queries live at the end; evict from the front
+            history.move_to_end(query)
+            while len(history) > MAX_HISTORY_QUERIES:
+                history.popitem(last=False)
+
+            self.history_version += 1
+            self._history_dirty = True
+            if self._history_flush_timer is None:
+                self._history_flush_timer = threading.Timer(HISTORY_FLUSH_DELAY, self.flush_history)
+                self._history_flush_timer.daemon = True
+                self._history_flush_timer.start()
+
+    def flush_history(self):
+        """Write pending history changes to history.json"""
+        with self._history_lock:
+            if self._history_flush_timer is not None:
+                self._history_flush_timer.cancel()
+                self._history_flush_timer = None
+            if self._history_dirty:
+                self.save_history(self._history_cache)
+                self._history_dirty = False
+
 class KeywordQueryEventListener(EventListener):
+    def __init__(self):
+        super(KeywordQueryEventListener, self).__init__()
+        # Ranked snippets of recent queries, least recently used first
+        self._result_cache = OrderedDict()
+
     def on_event(self, event, extension):
         query = event.get_argument() or ""
+
+        # Read preferences once per event
         preferences = extension.preferences
-        db_path = os.path.expanduser(preferences['mc_db_path'])
+        db_path = extension.get_db_path()
+        history_enabled = preferences.get('enable_history', 'true') == 'true'
+
         snippets = extension.load_snippets(db_path)
-        history = extension.load_history()
+        history = extension.load_history() if history_enabled else {}
+        history_version = extension.history_version if history_enabled else None
 
-        # History for this specific query
-        query_history = history.get(query, {})
+        # Retyping or deleting characters often repeats a recent query: reuse its
+        # ranking as long as neither db.json nor the history changed since
+        cache_key = (query, extension.snippet_cache_key, history_version)
+        top_snippets = self._result_cache.get(cache_key)
+        if top_snippets is None:
+            if query:
+                top_snippets = self.rank_snippets(query, snippets, history.get(query, {}), extension)
+            else:
+                # Nothing to match against: show the most selected snippets without scoring anything
+                top_snippets = self.rank_by_selection_count(snippets, history)
+            self._result_cache[cache_key] = top_snippets
+            if len(self._result_cache) > RESULT_CACHE_SIZE:
+                self._result_cache.popitem(last=False)
+        else:
+            self._result_cache.move_to_end(cache_key)
 
-        # Build a list of results based on history and fuzzy scores
-        matches = []
+        return RenderResultListAction(self.build_items(query, top_snippets, history_enabled))
 
-        for snippet in snippets:
-            name = snippet.get('name', '')
-            content = snippet.get('content', '')
+    def rank_by_selection_count(self, snippets, history):
+        """Return the MAX_RESULTS snippets selected most often over all queries"""
+        totals = {}
+        for query_history in history.values():
+            for name, count in query_history.items():
+                totals[name] = totals.get(name, 0) + count
 
-            if isinstance(content, list):
-                content_text = "\n".join(fragment.get('value', '') for fragment in content)
-            else:
-                content_text = content
+        if not totals:
+            return snippets[:MAX_RESULTS]
+        return heapq.nlargest(MAX_RESULTS, snippets, key=lambda snippet: totals.get(snippet.get('name', ''), 0))
+
+    def rank_snippets(self, query, snippets, query_history, extension):
+        """Return the best MAX_RESULTS snippets for query"""
+        load_fuzzy_matcher()
+
+        query_lower = query.lower()
+        candidates = None
 
-            title_score = fuzz.partial_ratio(query.lower(), name.lower())
-            content_score = fuzz.partial_ratio(query.lower(), content_text.lower())
-            combined_score = (0.8 * title_score) + (0.2 * content_score)
+        # Short queries are ranked on the title alone, and a title scores a perfect 100
+        # exactly when it contains the query or is contained in it. When enough titles
+        # do, nothing else can make the results, so only those (and the snippets already
+        # picked for this query) need scoring. Longer queries also score content, which
+        # can lift any title above a perfect one, so they always scan the whole library.
+        if len(query_lower) < MIN_CONTENT_QUERY_LENGTH:
+            substring_matches = [
+                index for index, name_lower in enumerate(extension.snippet_names_lower)
+                if query_lower in name_lower or (name_lower and name_lower in query_lower)
+            ]
+            if len(substring_matches) >= MAX_RESULTS:
+                candidates = set(substring_matches)
 
-            if combined_score > 50:
-                matches.append({
-                    'snippet': snippet,
-                    'score': combined_score,
-                    'history_count': query_history.get(name, 0)  # Number of selections for this query
-                })
+        if candidates is None:
+            names = extension.snippet_names_lower
+        else:
+            if query_history:
+                for snippet_name in query_history:
+                    candidates.update(extension.find_snippets_by_name(snippet_name))
+            names = {index: extension.snippet_names_lower[index] for index in candidates}
 
-        # Sort: first by number of selections for this query, then by similarity score
-        matches.sort(key=lambda x: (-x['history_count'], -x['score']))
+        if len(query_lower) >= MIN_CONTENT_QUERY_LENGTH:
+            # A snippet can only pass the threshold if its title score is
+            # high enough for a perfect content score to make up the rest
+            title_cutoff = (FUZZY_SCORE_THRESHOLD - CONTENT_WEIGHT * 100) / TITLE_WEIGHT
+        else:
+            # Rank on the title alone
+            title_cutoff = FUZZY_SCORE_THRESHOLD
 
+        # Score all titles in one batch
+        title_scores = score_choices(query_lower, names, title_cutoff)
+
+        # Number of selections of each surviving snippet for this query
+        history_counts = {index: query_history.get(snippets[index].get('name', ''), 0) for index in title_scores}
+
+        if len(query_lower) >= MIN_CONTENT_QUERY_LENGTH:
+            # Content adds at most CONTENT_WEIGHT * 100 to the weighted title score. Once
+            # MAX_RESULTS snippets are sure to pass the threshold, the ones whose best
+            # possible score can't reach them don't need their content scored.
+            sure_matches = [
+                (history_counts[index], TITLE_WEIGHT * title_score)
+                for index, title_score in title_scores.items() if TITLE_WEIGHT * title_score > FUZZY_SCORE_THRESHOLD
+            ]
+            if len(sure_matches) >= MAX_RESULTS:
+                lowest_top_match = heapq.nlargest(MAX_RESULTS, sure_matches)[-1]
+                title_scores = {
+                    index: title_score for index, title_score in title_scores.items()
+                    if (history_counts[index], TITLE_WEIGHT * title_score + CONTENT_WEIGHT * 100) >= lowest_top_match
+                }
+
+            content_scores = score_choices(query_lower, {
+                index: extension.snippet_contents_lower[index] for index in title_scores
+            }, substring_first=True)
+        else:
+            content_scores = None
+
+        # Build a list of results based on history and fuzzy scores. Each match is a
+        # (selections for this query, similarity score, -index) tuple, so tuple comparison
+        # ranks by history, then similarity, then database order without a key function.
+        if content_scores is None:
+            combined_scores = title_scores
+        else:
+            combined_scores = {
+                index: (TITLE_WEIGHT * title_score) + (CONTENT_WEIGHT * content_scores.get(index, 0))
+                for index, title_score in title_scores.items()
+            }
+        matches = [
+            (history_counts[index], combined_score, -index)
+            for index, combined_score in combined_scores.items() if combined_score > FUZZY_SCORE_THRESHOLD
+        ]
+
+        # Only the top MAX_RESULTS are shown, so there is no need to sort every match
+        return [snippets[-index] for _, _, index in heapq.nlargest(MAX_RESULTS, matches)]
+
+    def build_items(self, query, snippets, history_enabled):
+        """Build the result items displayed for the given snippets"""
         items = []
-        copy_paste_mode = preferences.get('copy_paste_mode', 'copy')
 
-        for match in matches[:5]:  # Limit to 5 results
-            snippet = match['snippet']
-            content_text = "\n".join(fragment.get('value', '') for fragment in snippet['content']) if isinstance(snippet['content'], list) else snippet['content']
+        for snippet in snippets:
+            content_text = snippet['content_text']
 
-            # Define action based on mode
-            action = CopyToClipboardAction(content_text)  # Simply copy the content
+            # Define action based on mode: copy the content, going through
+            # ItemEnterEventListener first when the selection must be recorded
+            if history_enabled:
+                action = ExtensionCustomAction({
+                    'query': query,
+                    'snippet_name': snippet['name'],
+                    'content': content_text
+                }, keep_app_open=False)
+            else:
+                action = CopyToClipboardAction(content_text)
 
             # Add item to results
             items.append(ExtensionResultItem(
                 icon='images/icon.png',
                 name=snippet['name'],
-                description=content_text[:100] + '...' if len(content_text) > 100 else content_text,
+                description=snippet['preview'],
                 on_enter=action
             ))
 
-        return RenderResultListAction(items)
+        return items
 
 class ItemEnterEventListener(EventListener):
     def on_event(self, event, extension):
@@ -119,28 +420,17 @@ class ItemEnterEventListener(EventListener):
         if not data:
             return RenderResultListAction([])
 
-        # Extract data for history update
-        query = data.get('query')
-        snippet_name = data.get('snippet_name')
-
-        # Update history
-        history = extension.load_history()
-        if query not in history:
-            history[query] = {}
-        if snippet_name not in history[query]:
-            history[query][snippet_name] = 0
-        history[query][snippet_name] += 1  # Increment counter
-        extension.save_history(history)
-
-        # Display action result
-        return RenderResultListAction([
-            ExtensionResultItem(
-                icon='images/icon.png',
-                name='Snippet copied',
-                description='Content copied to clipboard',
-                on_enter=CopyToClipboardAction(data.get('content', ''))
-            )
-        ])
+        # Record the selection in memory, then copy the snippet in the same round-trip
+        if extension.preferences.get('enable_history', 'true') == 'true':
+            extension.update_history(data.get('query'), data.get('snippet_name'))
+
+        return CopyToClipboardAction(data.get('content', ''))
+
+class SystemExitEventListener(EventListener):
+    def on_event(self, event, extension):
+        # Ulauncher exits the process right after this event without running atexit
+        # handlers, so selections still waiting for the flush timer are written now
+        extension.flush_history()
 
 if __name__ == '__main__':
     MassCodeExtension().run()